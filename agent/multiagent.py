@@ -1,16 +1,26 @@
 # Environment Dependencies
+import asyncio
+import logging
+import os
+from contextlib import AsyncExitStack
 from dotenv import load_dotenv
 
 # Memory and Checkpoint Dependencies
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
+import httpx
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, trim_messages
+from langchain_core.messages.utils import count_tokens_approximately
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.store.memory import InMemoryStore
 
 # State Dependencies
-from typing import Annotated, List
+import re
+import textwrap
+from functools import lru_cache
+from typing import Annotated, List, Literal
 from typing_extensions import TypedDict, Optional
 from langchain_core.runnables import RunnableConfig
+from langgraph.constants import TAG_NOSTREAM
 from langgraph.graph import StateGraph, START, END
 from langgraph.managed.is_last_step import RemainingSteps
 from langgraph.graph.message import AnyMessage, add_messages
@@ -18,56 +28,126 @@ from pydantic import BaseModel, Field
 
 # Prebuilts
 from langgraph.prebuilt import create_react_agent
-from langgraph_supervisor import create_supervisor
-from langgraph.types import interrupt
+from langgraph.types import Send, interrupt
 
 # Tools
-from agent.multiagent_helpers import invoice_tools, music_tools, get_customer_id_from_identifier
+from agent.multiagent_helpers import (
+    invoice_tools, invoice_tool_schemas, music_tools, music_tool_schemas, get_customer_id_from_identifier
+)
 
 
 load_dotenv(dotenv_path="../.env", override=True)
-model = ChatOpenAI(model="o3-mini")
-
+# One model instance (and HTTP/2 connection pool) shared by the supervisor, subagents, verification, and eval judge
+http_limits = httpx.Limits(max_keepalive_connections=50, max_connections=100)
+http_client = httpx.Client(http2=True, limits=http_limits, timeout=30.0)
+http_async_client = httpx.AsyncClient(http2=True, limits=http_limits, timeout=30.0)
+model = ChatOpenAI(model="o3-mini", http_client=http_client, http_async_client=http_async_client)
+
+# Semantic index for the long term memory store. Nothing reads or writes the store yet; once memories are
+# saved, every `put` is embedded with OpenAI and `store.search(..., query=...)` ranks items by similarity.
+# InMemoryStore still scores every item in the namespace; the Redis store uses its vector index instead.
+memory_index = {
+    "dims": 1536,
+    "embed": OpenAIEmbeddings(
+        model="text-embedding-3-small", http_client=http_client, http_async_client=http_async_client
+    ),
+}
+
+
+# Setting REDIS_URL moves thread checkpoints and long term memory out of the process heap,
+# so several workers can share conversations and threads survive restarts.
+REDIS_URL = os.getenv("REDIS_URL")
+# Otherwise, setting CHECKPOINT_DB (e.g. "checkpoints.db") persists thread checkpoints to a local SQLite file.
+CHECKPOINT_DB = os.getenv("CHECKPOINT_DB")
+# Both async backends need a running event loop, so they are only built by `await setup_persistence()`,
+# which the application must await once inside its event loop before the first graph run (and pair with
+# `await close_persistence()` on shutdown). Until then the in-memory backends below are used.
+
+logger = logging.getLogger(__name__)
+_persistence_ready = False
+_persistence_warned = False
+
+def warn_if_persistence_not_set_up():
+    """Log once when REDIS_URL or CHECKPOINT_DB is set but the graph is running on the in-memory backends."""
+    global _persistence_warned
+    if (REDIS_URL or CHECKPOINT_DB) and not _persistence_ready and not _persistence_warned:
+        _persistence_warned = True
+        logger.warning(
+            "%s is set but `await setup_persistence()` has not run; checkpoints are only kept in memory.",
+            "REDIS_URL" if REDIS_URL else "CHECKPOINT_DB",
+        )
 
 # Initializing long term memory store 
-in_memory_store = InMemoryStore()
+in_memory_store = InMemoryStore(index=memory_index)
 # Initializing checkpoint for thread-level memory 
 checkpointer = MemorySaver()
 
 
+def keep_latest(current: Optional[int], update: Optional[int]) -> Optional[int]:
+    """Reducer that keeps the most recent value, so parallel subagents can both report the same key."""
+    return update
+
+
+# Token budget for the conversation history carried in state and sent with every model call
+MAX_HISTORY_TOKENS = 4000
+
+
+def add_and_trim_messages(current: list[AnyMessage], update: list[AnyMessage]) -> list[AnyMessage]:
+    """Reducer that merges messages like add_messages, then trims older turns down to MAX_HISTORY_TOKENS.
+
+    The latest human turn (with its tool calls and results) and a leading SystemMessage are always kept,
+    even on their own over budget; earlier history is trimmed to start on a human turn so tool calls
+    are never separated from their results.
+    """
+    messages = add_messages(current, update)
+    last_human = next((i for i in range(len(messages) - 1, -1, -1) if isinstance(messages[i], HumanMessage)), 0)
+    pinned = messages[:1] if last_human > 0 and isinstance(messages[0], SystemMessage) else []
+    history, latest_turn = messages[len(pinned):last_human], messages[last_human:]
+
+    budget = MAX_HISTORY_TOKENS - count_tokens_approximately(pinned + latest_turn)
+    if history and budget > 0:
+        history = trim_messages(
+            history,
+            max_tokens=budget,
+            strategy="last",
+            token_counter=count_tokens_approximately,
+            start_on="human",
+        )
+    else:
+        history = []
+    return pinned + history + latest_turn
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Dedent a prompt and drop trailing and blank-line whitespace, keeping its line structure."""
+    lines = [line.rstrip() for line in textwrap.dedent(prompt).strip().splitlines()]
+    return "\n".join(line for i, line in enumerate(lines) if line or (i > 0 and lines[i - 1]))
+
 
 class State(TypedDict):
-    customer_id: str
-    messages: Annotated[list[AnyMessage], add_messages]
+    customer_id: Annotated[Optional[int], keep_latest]
+    messages: Annotated[list[AnyMessage], add_and_trim_messages]
     remaining_steps: RemainingSteps 
 
 ## Defining Invoice Subagent --------------------------------------------------------------------
-invoice_subagent_prompt = """
+invoice_subagent_prompt = normalize_prompt("""
     You are a subagent among a team of assistants. You are specialized for retrieving and processing invoice information. You are routed for invoice-related portion of the questions, so only respond to them.. 
 
     You have access to three tools. These tools enable you to retrieve and process invoice information from the database. Here are the tools:
-    - get_invoices_by_customer_sorted_by_date: This tool retrieves all invoices for a customer, sorted by invoice date.
-    - get_invoices_sorted_by_unit_price: This tool retrieves all invoices for a customer, sorted by unit price.
-    - get_employee_by_invoice_and_customer: This tool retrieves the employee information associated with an invoice and a customer.
+    - get_invoices_by_customer_sorted_by_date: This tool retrieves all invoices for the customer, sorted by invoice date.
+    - get_invoices_sorted_by_unit_price: This tool retrieves all invoices for the customer, sorted by unit price.
+    - get_employee_by_invoice_and_customer: This tool retrieves the employee information associated with one of the customer's invoices.
     
     If you are unable to retrieve the invoice information, inform the customer you are unable to retrieve the information, and ask if they would like to search for something else.
     
     CORE RESPONSIBILITIES:
-    - You must have the customer's ID before you can retrieve any information.
     - Retrieve and process invoice information from the database
     - Provide detailed information about invoices, including customer details, invoice dates, total amounts, employees associated with the invoice, etc. when the customer asks for it.
     - Always maintain a professional, friendly, and patient demeanor
-"""
- 
-invoice_subagent = create_react_agent(
-    model, tools=invoice_tools, 
-    name="invoice_information_subagent",
-    prompt=invoice_subagent_prompt, 
-    state_schema=State, 
-    checkpointer=checkpointer, store=in_memory_store)
+""")
 
 ## Defining Music Subagent --------------------------------------------------------------------
-music_subagent_prompt = """
+music_subagent_prompt = normalize_prompt("""
     You are a member of the assistant team, your role specifically is to focused on helping customers discover and learn about music in our digital catalog. 
     If you are unable to find playlists, songs, or albums associated with an artist, it is okay. 
     Just inform the customer that the catalog does not have any playlists, songs, or albums associated with that artist.
@@ -94,79 +174,195 @@ music_subagent_prompt = """
     4. If results aren't available, DO NOT MAKE ANY SONGS, ALBUMS, OR ARTISTS UP. Just say there are no results.
     
     Message history is also attached.  
-    """
-
-music_subagent = create_react_agent(
-    model, tools=music_tools, 
-    name="music_subagent",
-    prompt=music_subagent_prompt, 
-    state_schema=State, 
-    checkpointer=checkpointer, store=in_memory_store)
+    """)
+
+## Building Subagents --------------------------------------------------------------------
+SUBAGENT_CONFIGS = {
+    "invoice": ("invoice_information_subagent", invoice_subagent_prompt, invoice_tools, invoice_tool_schemas),
+    "music": ("music_subagent", music_subagent_prompt, music_tools, music_tool_schemas),
+}
+
+@lru_cache(maxsize=None)
+def _build_subagent(kind: Literal["invoice", "music"]):
+    """Build the compiled ReAct subagent for `kind` once; later calls return the cached graph."""
+    name, prompt, tools, tool_schemas = SUBAGENT_CONFIGS[kind]
+    # A static SystemMessage first keeps the prompt prefix byte-identical across calls for provider prompt caching;
+    # dynamic details (like the verified customer ID) only ever arrive later in the message list.
+    # Binding the precomputed schemas means create_react_agent reuses them instead of binding the tools itself.
+    # Subagent drafts are tagged "nostream": the customer only sees the aggregated reply streamed by `run`
+    return create_react_agent(
+        model.bind_tools(tool_schemas).with_config(tags=[TAG_NOSTREAM]), tools=tools, 
+        name=name,
+        prompt=SystemMessage(content=prompt), 
+        state_schema=State, 
+        checkpointer=checkpointer, store=in_memory_store)
+
+invoice_subagent = _build_subagent("invoice")
+music_subagent = _build_subagent("music")
 
 
 # Defining Multiagent Graph --------------------------------------------------------------------
-supervisor_prompt = """
+supervisor_prompt = normalize_prompt("""
     You are an expert customer support assistant for a digital music store. 
     You are dedicated to providing exceptional service and ensuring customer queries are answered thoroughly. 
     You have a team of subagents that you can use to help answer queries from customers. 
     Your primary role is to serve as a supervisor/planner for this multi-agent team that helps answer queries from customers. 
 
     Your team is composed of two subagents that you can use to help answer the customer's request:
-    1. music_catalog_information_subagent: this subagent has access to user's saved music preferences. It can also retrieve information about the digital music store's music 
+    1. music: this subagent has access to user's saved music preferences. It can also retrieve information about the digital music store's music 
     catalog (albums, tracks, songs, etc.) from the database. 
-    3. invoice_information_subagent: this subagent is able to retrieve information about a customer's past purchases or invoices 
+    2. invoice: this subagent is able to retrieve information about a customer's past purchases or invoices 
     from the database. 
 
     If the customer's request is related to music or invoices, you MUST route the request to the appropriate subagent. 
     If the customer's request is not related to music or invoices, you can respond to the customer yourself. 
 
-    Based on the existing steps that have been taken in the messages, your role is to generate the next subagent that needs to be called. 
-    This could be one step in an inquiry that needs multiple sub-agent calls.
-"""
+    Based on the existing steps that have been taken in the messages, your role is to choose every subagent needed to answer the latest request. 
+    Subagents you choose together run at the same time, so include all of them when an inquiry touches both music and invoices.
+""")
+
+aggregator_prompt = normalize_prompt("""
+    You are an expert customer support assistant for a digital music store. 
+    Your subagents have already looked up any music catalog or invoice information needed, and their findings are in the messages. 
+    Combine them into a single, complete, and friendly reply to the customer's latest request. 
+    If some information could not be looked up, say so. Do not make up information that is not in the messages.
+""")
+
+class SupervisorPlan(BaseModel):
+    """Routing decision for the customer's latest request."""
+    needs_subagent: bool = Field(
+        description="Whether the request needs music catalog or invoice information from a subagent."
+    )
+    targets: List[Literal["invoice", "music"]] = Field(
+        description="Subagents to route to when needs_subagent is true, otherwise empty."
+    )
+    response: str = Field(
+        description="Your direct reply to the customer when needs_subagent is false, otherwise an empty string."
+    )
+
+class SupervisorState(State):
+    targets: List[Literal["invoice", "music"]]
+
+# Maps planner targets to subagent node names
+SUBAGENT_NODES = {
+    "invoice": "invoice_information_subagent",
+    "music": "music_subagent",
+}
+
+# Tagged "nostream" so its JSON output is not forwarded to the customer by `run`
+planner_llm = model.with_structured_output(schema=SupervisorPlan).with_config(tags=[TAG_NOSTREAM])
+supervisor_system_message = SystemMessage(content=supervisor_prompt)
+aggregator_system_message = SystemMessage(content=aggregator_prompt)
+
+# Node
+async def planner(state: SupervisorState, config: RunnableConfig):
+    """Choose which subagents should handle the latest request."""
+    warn_if_persistence_not_set_up()
+    plan = await planner_llm.ainvoke([supervisor_system_message] + state["messages"])
+    if plan.needs_subagent and plan.targets:
+        return {"targets": plan.targets}
+
+    # No subagent needed: answer here and skip the fan-out and aggregator round-trips
+    if plan.response:
+        response = AIMessage(content=plan.response, name="supervisor")
+    else:
+        response = await model.ainvoke([supervisor_system_message] + state["messages"])
+    return {"targets": [], "messages": [response]}
 
+# conditional_edge
+def route_to_subagents(state: SupervisorState, config: RunnableConfig):
+    """Fan out to every chosen subagent in parallel, or finish if the planner already answered."""
+    targets = list(dict.fromkeys(state.get("targets") or []))
+    if not targets:
+        return END
+    # A subagent round-trip needs one step for the subagents and one for the aggregator
+    if state["remaining_steps"] <= 2:
+        return "aggregator"
+    subagent_input = {"customer_id": state.get("customer_id"), "messages": state["messages"]}
+    return [Send(SUBAGENT_NODES[target], subagent_input) for target in targets]
+
+# Node
+async def aggregator(state: SupervisorState, config: RunnableConfig):
+    """Join the subagents' findings into the final response."""
+    response = await model.ainvoke([aggregator_system_message] + state["messages"])
+    return {"messages": [response]}
 
 # Create supervisor workflow
-supervisor_prebuilt_workflow = create_supervisor(
-    agents=[invoice_subagent, music_subagent],
-    output_mode="full_history", # alternative is full_history
-    model=model,
-    prompt=(supervisor_prompt), 
-    state_schema=State
+supervisor_prebuilt_workflow = StateGraph(SupervisorState)
+supervisor_prebuilt_workflow.add_node("planner", planner)
+supervisor_prebuilt_workflow.add_node(SUBAGENT_NODES["invoice"], invoice_subagent)
+supervisor_prebuilt_workflow.add_node(SUBAGENT_NODES["music"], music_subagent)
+supervisor_prebuilt_workflow.add_node("aggregator", aggregator)
+
+supervisor_prebuilt_workflow.add_edge(START, "planner")
+supervisor_prebuilt_workflow.add_conditional_edges(
+    "planner",
+    route_to_subagents,
+    [*SUBAGENT_NODES.values(), "aggregator", END],
 )
+for subagent_node in SUBAGENT_NODES.values():
+    supervisor_prebuilt_workflow.add_edge(subagent_node, "aggregator")
+supervisor_prebuilt_workflow.add_edge("aggregator", END)
+
+# Caps every run (and the subagents' ReAct loops, which inherit the config) so tool retries cannot run up OpenAI cost
+RECURSION_LIMIT = 8
 
-supervisor_prebuilt = supervisor_prebuilt_workflow.compile(name="music_catalog_subagent", checkpointer=checkpointer, store=in_memory_store)
+supervisor_prebuilt = supervisor_prebuilt_workflow.compile(name="music_catalog_subagent", checkpointer=checkpointer, store=in_memory_store).with_config(recursion_limit=RECURSION_LIMIT)
 
 # Adding Human in the Loop --------------------------------------------------------------------
 class UserInput(BaseModel):
     """Schema for parsing user-provided account information."""
     identifier: str = Field(description = "Identifier, which can be a customer ID, email, or phone number.")
 
-structured_llm = model.with_structured_output(schema=UserInput)
+# Messages that are nothing but a customer ID, phone number, or email skip the extraction LLM call
+IDENTIFIER_PATTERNS = [
+    re.compile(r"\d{1,10}"),                   # customer ID
+    re.compile(r"\+[\d\s().-]{6,24}"),         # phone number, e.g. +55 (12) 3923-5555
+    re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+"),   # email
+]
+
+def match_identifier(content) -> Optional[str]:
+    """Return the message content if it is exactly a customer identifier, otherwise None."""
+    if not isinstance(content, str):
+        return None
+    content = content.strip()
+    for pattern in IDENTIFIER_PATTERNS:
+        if pattern.fullmatch(content):
+            return content
+    return None
+
+structured_llm = model.with_structured_output(schema=UserInput).with_config(tags=[TAG_NOSTREAM])
 structured_system_prompt = """You are a customer service representative responsible for extracting customer identifier.\n 
 Only extract the customer's account information from the message history. 
 If they haven't provided the information yet, return an empty string for the file"""
 
 
 
+verify_system_message = SystemMessage(content=normalize_prompt("""
+    You are a music store agent, where you are trying to verify the customer identity 
+    as the first step of the customer support process. 
+    Only after their account is verified, you would be able to support them on resolving the issue. 
+    In order to verify their identity, one of their customer ID, email, or phone number needs to be provided.
+    If the customer has not provided their identifier, please ask them for it.
+    If they have provided the identifier but cannot be found, please ask them to revise it."""))
+structured_system_message = SystemMessage(content=structured_system_prompt)
+
 # Node
-def verify_info(state: State, config: RunnableConfig):
+async def verify_info(state: State, config: RunnableConfig):
     """Verify the customer's account by parsing their input and matching it with the database."""
+    warn_if_persistence_not_set_up()
 
     if state.get("customer_id") is None: 
-        system_instructions = """You are a music store agent, where you are trying to verify the customer identity 
-        as the first step of the customer support process. 
-        Only after their account is verified, you would be able to support them on resolving the issue. 
-        In order to verify their identity, one of their customer ID, email, or phone number needs to be provided.
-        If the customer has not provided their identifier, please ask them for it.
-        If they have provided the identifier but cannot be found, please ask them to revise it."""
-
         user_input = state["messages"][-1] 
     
-        # Parse for customer ID
-        parsed_info = structured_llm.invoke([SystemMessage(content=structured_system_prompt)] + [user_input])
+        # Fast path: the message is just the identifier
+        identifier = match_identifier(user_input.content)
+        if identifier is None:
+            # Parse for customer ID
+            parsed_info = await structured_llm.ainvoke([structured_system_message, user_input])
     
-        # Extract details
-        identifier = parsed_info.identifier
+            # Extract details
+            identifier = parsed_info.identifier
     
         customer_id = ""
         # Attempt to find the customer ID
@@ -182,7 +378,7 @@ def verify_info(state: State, config: RunnableConfig):
                   "messages" : [intent_message]
                   }
         else:
-          response = model.invoke([SystemMessage(content=system_instructions)]+state['messages'])
+          response = await model.ainvoke([verify_system_message]+state['messages'])
           return {"messages": [response]}
     else: 
         pass
@@ -202,6 +398,7 @@ def should_interrupt(state: State, config: RunnableConfig):
         return "interrupt"
     
 # Final Graph --------------------------------------------------------------------
+# Every model call in the graph is async, so run it with `await multiagent.ainvoke(...)`.
 multi_agent_verify = StateGraph(State) # Adding in input state schema 
 multi_agent_verify.add_node("verify_info", verify_info)
 multi_agent_verify.add_node("human_input", human_input)
@@ -218,4 +415,63 @@ multi_agent_verify.add_conditional_edges(
 )
 multi_agent_verify.add_edge("human_input", "verify_info")
 multi_agent_verify.add_edge("supervisor", END)
-multiagent = multi_agent_verify.compile(name="multi_agent_verify", checkpointer=checkpointer, store=in_memory_store)
\ No newline at end of file
+multiagent = multi_agent_verify.compile(name="multi_agent_verify", checkpointer=checkpointer, store=in_memory_store).with_config(recursion_limit=RECURSION_LIMIT)
+
+async def run(inputs, config: RunnableConfig):
+    """Run the multiagent graph, yielding model token chunks as they are generated instead of waiting for the final state."""
+    async for event in multiagent.astream_events(inputs, config=config, version="v2"):
+        if event["event"] == "on_chat_model_stream" and TAG_NOSTREAM not in event.get("tags", []):
+            yield event["data"]["chunk"]
+        # A direct answer from the planner comes out of its (unstreamed) structured plan, so forward it whole
+        elif event["event"] == "on_chain_end" and event["name"] == "planner" and event["metadata"].get("langgraph_node") == "planner":
+            for message in (event["data"].get("output") or {}).get("messages", []):
+                if message.name == "supervisor":
+                    yield AIMessageChunk(content=message.content, id=message.id, name=message.name)
+
+# Persistence Setup --------------------------------------------------------------------
+_persistence_lock = asyncio.Lock()
+# Owns the Redis clients / SQLite connection opened by setup_persistence
+_persistence_stack = AsyncExitStack()
+
+async def setup_persistence():
+    """
+    Build the durable backend selected by REDIS_URL or CHECKPOINT_DB and attach it to every compiled graph.
+    Must be awaited inside the running event loop before the first graph run. Safe to call repeatedly.
+    """
+    global checkpointer, in_memory_store, _persistence_ready
+    async with _persistence_lock:
+        if _persistence_ready:
+            return
+        if REDIS_URL:
+            from langgraph.checkpoint.redis.aio import AsyncRedisSaver
+            from langgraph.store.redis.aio import AsyncRedisStore
+
+            # Entering the saver's context creates its indexes
+            checkpointer = await _persistence_stack.enter_async_context(AsyncRedisSaver(redis_url=REDIS_URL))
+            in_memory_store = await _persistence_stack.enter_async_context(
+                AsyncRedisStore(redis_url=REDIS_URL, index=memory_index)
+            )
+            await in_memory_store.setup()
+        elif CHECKPOINT_DB:
+            import aiosqlite
+            from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+            conn = await aiosqlite.connect(CHECKPOINT_DB)
+            _persistence_stack.push_async_callback(conn.close)
+            # WAL lets readers run alongside the writer; NORMAL syncs once per WAL checkpoint instead of every commit
+            await conn.executescript("PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;")
+            checkpointer = AsyncSqliteSaver(conn)
+            await checkpointer.setup()
+        for graph in (invoice_subagent, music_subagent, supervisor_prebuilt, multiagent):
+            graph.checkpointer = checkpointer
+            graph.store = in_memory_store
+        _persistence_ready = True
+
+async def close_persistence():
+    """
+    Close the connections opened by setup_persistence; the SQLite worker thread otherwise keeps the process alive.
+    """
+    global _persistence_ready
+    async with _persistence_lock:
+        await _persistence_stack.aclose()
+        _persistence_ready = False
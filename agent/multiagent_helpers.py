@@ -1,10 +1,13 @@
 from langchain_core.tools import tool
+from langchain_core.utils.function_calling import convert_to_openai_tool
 import requests
 import sqlite3
 from sqlalchemy import create_engine
 from sqlalchemy.pool import StaticPool
 from langchain_community.utilities.sql_database import SQLDatabase
-from typing import Optional 
+from langgraph.prebuilt import InjectedState
+from typing import Annotated, Optional 
+from functools import lru_cache
 import ast
 
 
@@ -28,35 +31,24 @@ engine = get_engine_for_chinook_db()
 db = SQLDatabase(engine)
 
 ## Invoice Subagent Tools ----------------------------------------------------------------
+# The invoice tools read the verified customer ID from graph state instead of taking it as a model-generated
+# argument, so it is left out of their schemas and the model never has to ask for or copy it.
+CustomerId = Annotated[Optional[int], InjectedState("customer_id")]
+MISSING_CUSTOMER_ID = "The customer's account has not been verified yet, so their invoices cannot be looked up."
+
 @tool 
-def get_invoices_by_customer_sorted_by_date(customer_id: str) -> list[dict]:
-    """
-    Look up all invoices for a customer using their ID.
-    The invoices are sorted in descending order by invoice date, which helps when the customer wants to view their most recent/oldest invoice, or if 
-    they want to view invoices within a specific date range.
-    
-    Args:
-        customer_id (str): customer_id, which serves as the identifier.
-    
-    Returns:
-        list[dict]: A list of invoices for the customer.
-    """
+def get_invoices_by_customer_sorted_by_date(customer_id: CustomerId) -> str:
+    """Get the customer's invoices, newest first; use for recent/oldest invoices or date ranges."""
+    if customer_id is None:
+        return MISSING_CUSTOMER_ID
     return db.run(f"SELECT * FROM Invoice WHERE CustomerId = {customer_id} ORDER BY InvoiceDate DESC;")
 
 
 @tool 
-def get_invoices_sorted_by_unit_price(customer_id: str) -> list[dict]:
-    """
-    Use this tool when the customer wants to know the details of one of their invoices based on the unit price/cost of the invoice.
-    This tool looks up all invoices for a customer, and sorts the unit price from highest to lowest. In order to find the invoice associated with the customer, 
-    we need to know the customer ID.
-    
-    Args:
-        customer_id (str): customer_id, which serves as the identifier.
-    
-    Returns:
-        list[dict]: A list of invoices sorted by unit price.
-    """
+def get_invoices_sorted_by_unit_price(customer_id: CustomerId) -> str:
+    """Get the customer's invoice lines, highest unit price first."""
+    if customer_id is None:
+        return MISSING_CUSTOMER_ID
     query = f"""
         SELECT Invoice.*, InvoiceLine.UnitPrice
         FROM Invoice
@@ -68,18 +60,10 @@ def get_invoices_sorted_by_unit_price(customer_id: str) -> list[dict]:
 
 
 @tool
-def get_employee_by_invoice_and_customer(invoice_id: str, customer_id: str) -> dict:
-    """
-    This tool will take in an invoice ID and a customer ID and return the employee information associated with the invoice.
-
-    Args:
-        invoice_id (int): The ID of the specific invoice.
-        customer_id (str): customer_id, which serves as the identifier.
-
-    Returns:
-        dict: Information about the employee associated with the invoice.
-    """
-
+def get_employee_by_invoice_and_customer(invoice_id: str, customer_id: CustomerId) -> str:
+    """Get the support employee for one of the customer's invoices."""
+    if customer_id is None:
+        return MISSING_CUSTOMER_ID
     query = f"""
         SELECT Employee.FirstName, Employee.Title, Employee.Email
         FROM Employee
@@ -95,11 +79,13 @@ def get_employee_by_invoice_and_customer(invoice_id: str, customer_id: str) -> d
     return employee_info
 
 invoice_tools = [get_invoices_by_customer_sorted_by_date, get_invoices_sorted_by_unit_price, get_employee_by_invoice_and_customer]
+# JSON schemas generated once at import, so agents can bind them without re-introspecting the tools.
+# Tool docstrings become the schema descriptions sent on every model call, so they are kept to one line;
+# the subagent prompts already explain when to use each tool. The schemas deliberately omit
+# "additionalProperties": false, which would add tokens to every call rather than remove them.
+invoice_tool_schemas = [convert_to_openai_tool(t) for t in invoice_tools]
 
 ## Music Subagent Tools ----------------------------------------------------------------
-from langchain_core.tools import tool
-import ast
-
 @tool
 def get_albums_by_artist(artist: str):
     """Get albums by an artist."""
@@ -129,15 +115,7 @@ def get_tracks_by_artist(artist: str):
 
 @tool
 def get_songs_by_genre(genre: str):
-    """
-    Fetch songs from the database that match a specific genre.
-    
-    Args:
-        genre (str): The genre of the songs to fetch.
-    
-    Returns:
-        list[dict]: A list of songs that match the specified genre.
-    """
+    """Get up to 8 songs in a genre."""
     genre_id_query = f"SELECT GenreId FROM Genre WHERE Name LIKE '%{genre}%'"
     genre_ids = db.run(genre_id_query)
     if not genre_ids:
@@ -164,7 +142,7 @@ def get_songs_by_genre(genre: str):
     ]
 
 @tool
-def check_for_songs(song_title):
+def check_for_songs(song_title: str):
     """Check if a song exists by its name."""
     return db.run(
         f"""
@@ -174,9 +152,12 @@ def check_for_songs(song_title):
     )
 
 music_tools = [get_albums_by_artist, get_tracks_by_artist, get_songs_by_genre, check_for_songs]
+music_tool_schemas = [convert_to_openai_tool(t) for t in music_tools]
 
 
 # Helper 
+# The Chinook database is loaded once and never modified, so lookups can be cached for the process lifetime.
+@lru_cache(maxsize=4096)
 def get_customer_id_from_identifier(identifier: str) -> Optional[int]:
     """
     Retrieve Customer ID using an identifier, which can be a customer ID, email, or phone number.
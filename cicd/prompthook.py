@@ -1,13 +1,19 @@
+import asyncio
 import base64
-import json
+import hashlib
+import logging
 import uuid
-from typing import Any, Dict
+from contextlib import asynccontextmanager
+from typing import Annotated, Any, Dict, Tuple
 
 import httpx
-from fastapi import FastAPI, HTTPException, Body
-from pydantic import BaseModel, Field
+import msgspec
+import orjson
+from fastapi import FastAPI, HTTPException, Request
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+logger = logging.getLogger(__name__)
+
 # --- Configuration ---
 class AppConfig(BaseSettings):
     """
@@ -28,137 +34,280 @@ class AppConfig(BaseSettings):
 
 settings = AppConfig()
 
-# --- Pydantic Models ---
-class WebhookPayload(BaseModel):
+# --- GitHub HTTP Client ---
+# A single long-lived client so the Git Data API calls reuse pooled (HTTP/2)
+# connections instead of paying a fresh TLS handshake per webhook.
+_client = httpx.AsyncClient(
+    base_url="https://api.github.com",
+    http2=True,
+    timeout=httpx.Timeout(10.0),
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    headers={
+        "Authorization": f"Bearer {settings.GITHUB_TOKEN}",
+        "Accept": "application/vnd.github.v3+json",
+        "X-GitHub-Api-Version": "2022-11-28",
+    },
+)
+
+# Last known (commit SHA, tree SHA) at the head of each branch. Every commit we create
+# becomes the new head, so the next commit can build on it without reading the ref first.
+_branch_head_cache: Dict[str, Tuple[str, str]] = {}
+
+# (head commit SHA, git blob SHA) of each file path as of the last head this process saw.
+# Only a hint: other workers or manual edits can move the branch, so the head is re-read before skipping.
+_file_blob_at_head: Dict[str, Tuple[str, str]] = {}
+
+# Webhooks arriving within this window of each other are coalesced into one commit.
+COMMIT_COALESCE_WINDOW_SECONDS = 0.2
+
+# How long shutdown waits for already-acknowledged webhooks to be committed.
+SHUTDOWN_DRAIN_TIMEOUT_SECONDS = 30.0
+
+# --- Payload Models ---
+class WebhookPayload(msgspec.Struct):
     """
     Defines the expected structure of the incoming webhook payload.
+    Decoded with msgspec, which validates the raw body without deep-copying the manifest.
     """
-    prompt_id: uuid.UUID = Field(
-        ...,
+    prompt_id: Annotated[uuid.UUID, msgspec.Meta(
         description="The unique identifier for the prompt."
-    )
-    prompt_name: str = Field(
-        ...,
+    )]
+    prompt_name: Annotated[str, msgspec.Meta(
         description="The name/title of the prompt."
-    )
-    commit_hash: str = Field(
-        ...,
+    )]
+    commit_hash: Annotated[str, msgspec.Meta(
         description="An identifier for the commit event that triggered the webhook."
-    )
-    created_at: str = Field(
-        ...,
+    )]
+    created_at: Annotated[str, msgspec.Meta(
         description="Timestamp indicating when the event was created (ISO format preferred)."
-    )
-    created_by: str = Field(
-        ...,
+    )]
+    created_by: Annotated[str, msgspec.Meta(
         description="The name of the user who created the event."
-    )
-    manifest: Dict[str, Any] = Field(
-        ...,
+    )]
+    manifest: Annotated[Dict[str, Any], msgspec.Meta(
         description="The main content or configuration data to be committed to GitHub."
-    )
+    )]
+
+_payload_decoder = msgspec.json.Decoder(WebhookPayload)
+
+# --- GitHub Helper Functions ---
+async def github_request(method: str, path: str, step: str, **kwargs) -> Dict[str, Any]:
+    """
+    Helper function to call the GitHub API, translating failures into HTTPExceptions.
+    """
+    try:
+        response = await _client.request(method, path, **kwargs)
+        response.raise_for_status()
+        return response.json()
+    except httpx.HTTPStatusError as e:
+        error_detail = f"GitHub API error ({step}): {e.response.status_code} - {e.response.text}"
+        if e.response.status_code == 409: # Conflict
+            error_detail = (
+                f"GitHub API conflict ({step}): {e.response.text}. "
+                "This might be due to branch protection rules."
+            )
+        elif e.response.status_code == 422: # Unprocessable Entity
+            error_detail = (
+                f"GitHub API Unprocessable Entity ({step}): {e.response.text}. "
+                f"Ensure the branch '{settings.GITHUB_BRANCH}' exists and the payload is correctly formatted."
+            )
+        raise HTTPException(status_code=e.response.status_code, detail=error_detail)
+    except httpx.RequestError as e:
+        error_detail = f"Network error connecting to GitHub ({step}): {str(e)}"
+        raise HTTPException(status_code=503, detail=error_detail)
+
+async def get_branch_head(repo_path: str) -> Tuple[str, str]:
+    """
+    Helper function to fetch the (commit SHA, tree SHA) at the head of the configured branch.
+    """
+    ref = await github_request("GET", f"{repo_path}/git/ref/heads/{settings.GITHUB_BRANCH}", "GET branch ref")
+    commit_sha = ref["object"]["sha"]
+    commit = await github_request("GET", f"{repo_path}/git/commits/{commit_sha}", "GET head commit")
+    return commit_sha, commit["tree"]["sha"]
+
+def git_blob_sha(content: bytes) -> str:
+    """
+    Helper function to compute the SHA git (and GitHub) assigns to a blob with this content.
+    """
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
 
-# --- GitHub Helper Function ---
 async def commit_manifest_to_github(payload: WebhookPayload) -> Dict[str, Any]:
     """
     Helper function to commit the manifest directly to the configured branch.
+    Uses the Git Data API (blob -> tree -> commit -> ref) so no read of the current file is needed.
     """
-    github_api_base_url = "https://api.github.com"
-    repo_file_url = (
-        f"{github_api_base_url}/repos/{settings.GITHUB_REPO_OWNER}/"
-        f"{settings.GITHUB_REPO_NAME}/contents/{settings.GITHUB_FILE_PATH}"
-    )
+    repo_path = f"/repos/{settings.GITHUB_REPO_OWNER}/{settings.GITHUB_REPO_NAME}"
 
-    headers = {
-        "Authorization": f"Bearer {settings.GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json",
-        "X-GitHub-Api-Version": "2022-11-28",
-    }
+    manifest_bytes = orjson.dumps(payload.manifest, option=orjson.OPT_INDENT_2)
+    blob_sha = git_blob_sha(manifest_bytes)
+    unchanged = {"committed": False, "reason": "unchanged"}
+
+    # Whether `head` was just read from GitHub rather than taken from the cache
+    head_is_fresh = False
+    known = _file_blob_at_head.get(settings.GITHUB_FILE_PATH)
+    if known is not None and known[1] == blob_sha:
+        head = await get_branch_head(repo_path)
+        head_is_fresh = True
+        _branch_head_cache[settings.GITHUB_BRANCH] = head
+        if head[0] == known[0]:
+            return unchanged
 
-    manifest_json_string = json.dumps(payload.manifest, indent=2)
-    content_base64 = base64.b64encode(manifest_json_string.encode('utf-8')).decode('utf-8')
+    content_base64 = base64.b64encode(manifest_bytes).decode('ascii')
     commit_message = f"feat: Update {settings.GITHUB_FILE_PATH} via webhook - commit {payload.commit_hash}"
 
-    data_to_commit = {
-        "message": commit_message,
-        "content": content_base64,
-        "branch": settings.GITHUB_BRANCH,
-    }
+    create_blob = github_request(
+        "POST", f"{repo_path}/git/blobs", "POST blob",
+        json={"content": content_base64, "encoding": "base64"},
+    )
+    head = _branch_head_cache.get(settings.GITHUB_BRANCH)
+    if head is None:
+        blob, head = await asyncio.gather(create_blob, get_branch_head(repo_path))
+        head_is_fresh = True
+    else:
+        blob = await create_blob
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "PATCH %s%s/git/refs/heads/%s file=%s",
+            _client.base_url, repo_path, settings.GITHUB_BRANCH, settings.GITHUB_FILE_PATH,
+        )
 
-    async with httpx.AsyncClient() as client:
-        current_file_sha = None
+    for attempt in range(2):
+        head_commit_sha, head_tree_sha = head
+        tree = await github_request(
+            "POST", f"{repo_path}/git/trees", "POST tree",
+            json={
+                "base_tree": head_tree_sha,
+                "tree": [{"path": settings.GITHUB_FILE_PATH, "mode": "100644", "type": "blob", "sha": blob["sha"]}],
+            },
+        )
+        if tree["sha"] == head_tree_sha:
+            # The file already has this content at `head`; only trust that once the head is confirmed current.
+            if head_is_fresh:
+                _file_blob_at_head[settings.GITHUB_FILE_PATH] = (head_commit_sha, blob["sha"])
+                return unchanged
+            head = await get_branch_head(repo_path)
+            head_is_fresh = True
+            _branch_head_cache[settings.GITHUB_BRANCH] = head
+            continue
+        commit = await github_request(
+            "POST", f"{repo_path}/git/commits", "POST commit",
+            json={"message": commit_message, "tree": tree["sha"], "parents": [head_commit_sha]},
+        )
         try:
-            params_get = {"ref": settings.GITHUB_BRANCH}
-            response_get = await client.get(repo_file_url, headers=headers, params=params_get)
-            if response_get.status_code == 200:
-                current_file_sha = response_get.json().get("sha")
-            elif response_get.status_code != 404: # If not 404 (not found), it's an unexpected error
-                response_get.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            error_detail = f"GitHub API error (GET file SHA): {e.response.status_code} - {e.response.text}"
-            print(f"[ERROR] {error_detail}")
-            raise HTTPException(status_code=e.response.status_code, detail=error_detail)
-        except httpx.RequestError as e:
-            error_detail = f"Network error connecting to GitHub (GET file SHA): {str(e)}"
-            print(f"[ERROR] {error_detail}")
-            raise HTTPException(status_code=503, detail=error_detail)
-
-        if current_file_sha:
-            data_to_commit["sha"] = current_file_sha
+            await github_request(
+                "PATCH", f"{repo_path}/git/refs/heads/{settings.GITHUB_BRANCH}", "PATCH branch ref",
+                json={"sha": commit["sha"], "force": False},
+            )
+        except HTTPException as e:
+            _branch_head_cache.pop(settings.GITHUB_BRANCH, None)
+            # 422 means the branch moved since our cached head; rebuild on the real head once.
+            if e.status_code == 422 and attempt == 0:
+                head = await get_branch_head(repo_path)
+                head_is_fresh = True
+                continue
+            raise
+
+        _branch_head_cache[settings.GITHUB_BRANCH] = (commit["sha"], tree["sha"])
+        _file_blob_at_head[settings.GITHUB_FILE_PATH] = (commit["sha"], blob["sha"])
+        return {
+            "committed": True,
+            "commit": commit,
+            "content": {"path": settings.GITHUB_FILE_PATH, "sha": blob["sha"]},
+        }
+
+async def commit_manifest_in_background(payload: WebhookPayload) -> None:
+    """
+    Background worker that commits the manifest once the webhook has been acknowledged.
+    """
+    try:
+        github_response = await commit_manifest_to_github(payload)
+        if not github_response.get("committed", True):
+            logger.info("Skipped commit %s: manifest %s", payload.commit_hash, github_response.get("reason"))
+            return
+        logger.info(
+            "Committed manifest for prompt %s (commit %s): %s",
+            payload.prompt_name, payload.commit_hash, github_response.get("commit", {}).get("sha"),
+        )
+    except HTTPException as e:
+        logger.error("Background commit failed for commit %s: %s", payload.commit_hash, e.detail)
+    except Exception:
+        logger.exception("An unexpected error occurred in background commit %s", payload.commit_hash)
+
+async def commit_queue_consumer(queue: "asyncio.Queue[WebhookPayload]") -> None:
+    """
+    Drains queued webhooks in short bursts and commits only the newest payload of each burst.
+    Every payload overwrites the same GITHUB_FILE_PATH, so a rapid series of prompt updates
+    results in a single GitHub commit.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        latest = await queue.get()
+        received = 1
+        deadline = loop.time() + COMMIT_COALESCE_WINDOW_SECONDS
+        while (remaining := deadline - loop.time()) > 0:
+            try:
+                latest = await asyncio.wait_for(queue.get(), timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+            received += 1
 
         try:
-            print(f"PUT URL: {repo_file_url}")
-            print(f"File path: {settings.GITHUB_FILE_PATH}")
-            print(f"Branch: {settings.GITHUB_BRANCH}")
-            print(f"Repo owner: {settings.GITHUB_REPO_OWNER}")
-            print(f"Repo name: {settings.GITHUB_REPO_NAME}")
-            response_put = await client.put(repo_file_url, headers=headers, json=data_to_commit)
-            response_put.raise_for_status()
-            return response_put.json()
-        except httpx.HTTPStatusError as e:
-            error_detail = f"GitHub API error (PUT content): {e.response.status_code} - {e.response.text}"
-            if e.response.status_code == 409: # Conflict
-                error_detail = (
-                    f"GitHub API conflict (PUT content): {e.response.text}. "
-                    "This might be due to an outdated SHA or branch protection rules."
-                )
-            elif e.response.status_code == 422: # Unprocessable Entity
-                 error_detail = (
-                    f"GitHub API Unprocessable Entity (PUT content): {e.response.text}. "
-                    f"Ensure the branch '{settings.GITHUB_BRANCH}' exists and the payload is correctly formatted."
-                )
-            print(f"[ERROR] {error_detail}")
-            raise HTTPException(status_code=e.response.status_code, detail=error_detail)
-        except httpx.RequestError as e:
-            error_detail = f"Network error connecting to GitHub (PUT content): {str(e)}"
-            print(f"[ERROR] {error_detail}")
-            raise HTTPException(status_code=503, detail=error_detail)
+            await commit_manifest_in_background(latest)
+        finally:
+            for _ in range(received):
+                queue.task_done()
 
 # --- FastAPI Application ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Starts the commit queue consumer. On shutdown, commits the webhooks that were already
+    acknowledged before stopping the consumer and closing the shared GitHub client.
+    """
+    queue: "asyncio.Queue[WebhookPayload]" = asyncio.Queue()
+    app.state.commit_queue = queue
+    consumer = asyncio.create_task(commit_queue_consumer(queue))
+    yield
+    try:
+        await asyncio.wait_for(queue.join(), timeout=SHUTDOWN_DRAIN_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        dropped = [queue.get_nowait().commit_hash for _ in range(queue.qsize())]
+        logger.error(
+            "Shutdown timed out after %gs; cancelling the in-progress commit and dropping %d queued "
+            "webhook(s): %s",
+            SHUTDOWN_DRAIN_TIMEOUT_SECONDS, len(dropped), ", ".join(dropped) or "none",
+        )
+    consumer.cancel()
+    try:
+        await consumer
+    except asyncio.CancelledError:
+        pass
+    await _client.aclose()
+
 app = FastAPI(
     title="Minimal Webhook to GitHub Commit Service",
     description="Receives a webhook and commits its 'manifest' part directly to a GitHub repository.",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
-@app.post("/webhook/commit", status_code=201, tags=["GitHub Webhooks"])
-async def handle_webhook_direct_commit(payload: WebhookPayload = Body(...)):
+@app.post("/webhook/commit", status_code=202, tags=["GitHub Webhooks"])
+async def handle_webhook_direct_commit(request: Request):
     """
     Webhook endpoint to receive events and commit DIRECTLY to the configured branch.
+    The payload is queued for the commit consumer so the webhook is acknowledged immediately.
     """
     try:
-        github_response = await commit_manifest_to_github(payload)
-        return {
-            "message": "Webhook received and manifest committed directly to GitHub successfully.",
-            "github_commit_details": github_response.get("commit", {}),
-            "github_content_details": github_response.get("content", {})
-        }
-    except HTTPException:
-        raise # Re-raise if it's an HTTPException from the helper
-    except Exception as e:
-        error_message = f"An unexpected error occurred: {str(e)}"
-        print(f"[ERROR] {error_message}")
-        raise HTTPException(status_code=500, detail="An internal server error occurred.")
+        payload = _payload_decoder.decode(await request.body())
+    except msgspec.DecodeError as e: # Also covers msgspec.ValidationError
+        raise HTTPException(status_code=422, detail=f"Invalid webhook payload: {str(e)}")
+
+    app.state.commit_queue.put_nowait(payload)
+    return {
+        "status": "accepted",
+        "message": "Webhook received; manifest will be committed to GitHub in the background.",
+    }
 
 @app.get("/health", status_code=200, tags=["Health"])
 async def health_check():
@@ -170,4 +319,5 @@ async def health_check():
 # To run this server:
 # 1. Ensure your .env file contains your GitHub token and repo details.
 # 2. Run with Uvicorn: uvicorn cicd.prompthook:app --reload
-# 3. Deploy to a public platform like Render.com.
\ No newline at end of file
+# 3. Deploy to a public platform like Render.com, using the uvloop event loop and httptools parser:
+#    uvicorn cicd.prompthook:app --loop uvloop --http httptools --workers 2
\ No newline at end of file
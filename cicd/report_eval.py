@@ -10,9 +10,11 @@ import json
 import operator
 import os
 import sys
-from collections import defaultdict
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional
 
+import numpy as np
 from langsmith import Client
 
 # Operator map for threshold comparisons
@@ -25,18 +27,60 @@ OP_MAP = {
     "!=": operator.ne,
 }
 
+# Longest symbols first so ">=" is matched before ">"
+_SYMBOLS = sorted(OP_MAP.keys(), key=len, reverse=True)
+
+# Maximum number of experiments fetched from LangSmith at the same time
+MAX_CONCURRENT_EXPERIMENTS = 8
+
+# Number of run IDs per list_feedback request, and how many of those run at once per experiment
+FEEDBACK_CHUNK_SIZE = 200
+MAX_FEEDBACK_WORKERS = 4
+
+# Cap on LangSmith requests in flight across all experiment and feedback threads,
+# so the nested thread pools stay inside LangSmith rate limits
+MAX_CONCURRENT_REQUESTS = 8
+_request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
 
 def parse_threshold(threshold_str: str) -> tuple:
     """Parse threshold expression and return operator and value."""
-    for symbol in sorted(OP_MAP.keys(), key=len, reverse=True):
+    for symbol in _SYMBOLS:
         if threshold_str.startswith(symbol):
             return OP_MAP[symbol], float(threshold_str[len(symbol) :])
     raise ValueError(f"Invalid threshold format: {threshold_str}")
 
 
-def format_score(value: Optional[float]) -> str:
-    """Format score for display."""
-    return f"{value:.2f}" if value is not None else "N/A"
+def fetch_feedback(client: Client, experiment_name: str) -> Optional[List[Any]]:
+    """
+    Stream an experiment's runs and fetch their feedback in chunks while later
+    pages are still being paginated. Returns None if the experiment has no runs.
+    """
+
+    def list_chunk_feedback(run_ids: List[Any]) -> List[Any]:
+        with _request_slots:
+            return list(client.list_feedback(run_ids=run_ids))
+
+    runs = iter(client.list_runs(project_name=experiment_name))
+    with ThreadPoolExecutor(max_workers=MAX_FEEDBACK_WORKERS) as executor:
+        futures = []
+        run_ids = []
+        while True:
+            # Advancing the iterator may fetch the next page of runs
+            with _request_slots:
+                run = next(runs, None)
+            if run is None:
+                break
+            run_ids.append(run.id)
+            if len(run_ids) == FEEDBACK_CHUNK_SIZE:
+                futures.append(executor.submit(list_chunk_feedback, run_ids))
+                run_ids = []
+        if run_ids:
+            futures.append(executor.submit(list_chunk_feedback, run_ids))
+
+        if not futures:
+            return None
+        return [fb for future in futures for fb in future.result()]
 
 
 def process_config(config_path: str, client: Client) -> Dict[str, Any]:
@@ -58,32 +102,51 @@ def process_config(config_path: str, client: Client) -> Dict[str, Any]:
         return {}
 
     try:
-        runs = list(client.list_runs(project_name=experiment_name))
-        if not runs:
+        # Parse each threshold once; None marks an invalid expression. Malformed criteria
+        # (e.g. a non-string threshold) fall through to the error row below.
+        compiled_criteria = {}
+        for key, threshold_expr in criteria.items():
+            try:
+                compiled_criteria[key] = parse_threshold(threshold_expr)
+            except ValueError as e:
+                print(f"⚠️  Invalid threshold '{threshold_expr}' for key '{key}': {e}")
+                compiled_criteria[key] = None
+
+        feedbacks = fetch_feedback(client, experiment_name)
+        if feedbacks is None:
             print(f"⚠️  No runs found for experiment: {experiment_name}")
             return {"experiment_name": experiment_name, "results": []}
 
-        run_ids = [r.id for r in runs]
-        feedbacks = client.list_feedback(run_ids=run_ids)
-
-        feedback_by_key = defaultdict(list)
+        keys = []
+        scores = []
         for fb in feedbacks:
             if fb.score is not None:
-                feedback_by_key[fb.key].append(fb.score)
+                keys.append(fb.key)
+                scores.append(fb.score)
+
+        # Group-by mean over feedback keys
+        unique_keys, key_index = np.unique(keys, return_inverse=True)
+        score_sums = np.bincount(key_index, weights=np.asarray(scores, dtype=np.float64))
+        means = score_sums / np.bincount(key_index)
+        # Format every score in one pass; NaN marks a key without scores
+        display_scores = np.where(np.isnan(means), "N/A", np.char.mod("%.2f", means))
 
         table_rows = []
         num_passed = 0
         num_failed = 0
 
-        for key, scores in feedback_by_key.items():
-            avg_score = sum(scores) / len(scores) if scores else None
+        for key, avg_score, display_score in zip(
+            unique_keys.tolist(), means.tolist(), display_scores.tolist()
+        ):
             threshold_expr = criteria.get(key)
             passed = "N/A"
             check = "–"
 
-            if threshold_expr:
-                try:
-                    op, value = parse_threshold(threshold_expr)
+            # Without a score there is nothing to compare, so the row stays N/A
+            if threshold_expr and avg_score is not None:
+                compiled = compiled_criteria[key]
+                if compiled is not None:
+                    op, value = compiled
                     result = op(avg_score, value)
                     passed = "✅" if result else "❌"
                     check = threshold_expr
@@ -91,14 +154,10 @@ def process_config(config_path: str, client: Client) -> Dict[str, Any]:
                         num_passed += 1
                     else:
                         num_failed += 1
-                except ValueError as e:
-                    print(
-                        f"⚠️  Invalid threshold '{threshold_expr}' for key '{key}': {e}"
-                    )
+                else:
                     passed = "❌"
                     num_failed += 1
 
-            display_score = format_score(avg_score)
             table_rows.append((key, display_score, check, passed))
 
         return {
@@ -114,44 +173,64 @@ def process_config(config_path: str, client: Client) -> Dict[str, Any]:
         return {"experiment_name": experiment_name, "error": str(e)}
 
 
+def process_configs(config_paths: List[str], client: Client) -> List[Dict[str, Any]]:
+    """Process evaluation config files in parallel threads, preserving their order."""
+    if not config_paths:
+        return []
+
+    # The LangSmith Client is safe to share across threads for reads
+    max_workers = min(MAX_CONCURRENT_EXPERIMENTS, len(config_paths))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(
+            executor.map(lambda path: process_config(path, client), config_paths)
+        )
+
+
 def write_markdown_report(
     results: List[Dict[str, Any]], output_file: str = "eval_comment.md"
 ):
     """Write evaluation results to markdown file."""
     print(f"📝 Writing report to {output_file}")
 
-    with open(output_file, "w") as f:
-        f.write("# 🧪 LangSmith Evaluation Results\n\n")
-
-        for result in results:
-            experiment_name = result.get("experiment_name", "Unknown")
-
-            if "error" in result:
-                f.write(f"### ❌ {experiment_name}\n\n")
-                f.write(f"**Error:** {result['error']}\n\n")
-                continue
+    parts = []
+    append = parts.append
+    append("# 🧪 LangSmith Evaluation Results\n\n")
 
-            if not result.get("table_rows"):
-                f.write(f"### ⚠️ {experiment_name}\n\n")
-                f.write("No evaluation results found.\n\n")
-                continue
+    for result in results:
+        experiment_name = result.get("experiment_name", "Unknown")
 
-            f.write(f"### 📊 {experiment_name}\n\n")
-            f.write("| Feedback Key | Avg Score | Criterion | Pass? |\n")
-            f.write("|--------------|-----------|-----------|--------|\n")
+        if "error" in result:
+            append(f"### ❌ {experiment_name}\n\n")
+            append(f"**Error:** {result['error']}\n\n")
+            continue
 
-            for row in result["table_rows"]:
-                f.write(f"| {row[0]} | {row[1]} | {row[2]} | {row[3]} |\n")
+        if not result.get("table_rows"):
+            append(f"### ⚠️ {experiment_name}\n\n")
+            append("No evaluation results found.\n\n")
+            continue
 
-            total = result.get("total", 0)
-            if total > 0:
-                num_passed = result.get("num_passed", 0)
-                num_failed = result.get("num_failed", 0)
-                summary = f"**✅ {num_passed} Passed, ❌ {num_failed} Failed**"
-            else:
-                summary = "No thresholds defined."
+        append(f"### 📊 {experiment_name}\n\n")
+        append("| Feedback Key | Avg Score | Criterion | Pass? |\n")
+        append("|--------------|-----------|-----------|--------|\n")
+        append(
+            "".join(
+                f"| {row[0]} | {row[1]} | {row[2]} | {row[3]} |\n"
+                for row in result["table_rows"]
+            )
+        )
+
+        total = result.get("total", 0)
+        if total > 0:
+            num_passed = result.get("num_passed", 0)
+            num_failed = result.get("num_failed", 0)
+            summary = f"**✅ {num_passed} Passed, ❌ {num_failed} Failed**"
+        else:
+            summary = "No thresholds defined."
+
+        append(f"\n{summary}\n\n")
 
-            f.write(f"\n{summary}\n\n")
+    with open(output_file, "w") as f:
+        f.write("".join(parts))
 
     print(f"✅ Report written to {output_file}")
 
@@ -216,15 +295,18 @@ Examples:
         print(f"🔍 Found {len(config_files)} config files: {config_files}")
 
     # Process all config files
-    results = []
+    existing_config_files = []
     for config_path in config_files:
         if not os.path.exists(config_path):
             print(f"⚠️  Config file not found: {config_path}")
             continue
+        existing_config_files.append(config_path)
 
-        result = process_config(config_path, client)
-        if result:
-            results.append(result)
+    results = [
+        result
+        for result in process_configs(existing_config_files, client)
+        if result
+    ]
 
     if not results:
         print("❌ No valid evaluation results to process.")
@@ -1,9 +1,9 @@
 import pytest
+import pytest_asyncio
 import uuid
 import json
 
 from langgraph.types import Command
-from langchain_openai import ChatOpenAI
 from openevals.llm import create_async_llm_as_judge
 from openevals.prompts import CORRECTNESS_PROMPT
 from langsmith import Client
@@ -11,12 +11,10 @@ from dotenv import load_dotenv
 
 load_dotenv(dotenv_path=".env", override=True)
 
-from agent.multiagent import multiagent
+from agent.multiagent import model, multiagent, setup_persistence, close_persistence
 
 client = Client()
 
-model = ChatOpenAI(model="o3-mini")
-
 # Using Open Eval pre-built 
 correctness_evaluator = create_async_llm_as_judge(
     prompt=CORRECTNESS_PROMPT,
@@ -24,6 +22,13 @@ correctness_evaluator = create_async_llm_as_judge(
     judge=model,
 )
 
+@pytest_asyncio.fixture
+async def persistence():
+    """Prepare the graph's checkpoint backend, and always close it so an open SQLite connection cannot hang pytest."""
+    await setup_persistence()
+    yield
+    await close_persistence()
+
 async def run_graph(inputs: dict):
     """Run graph and track the final response."""
     # Creating configuration 
@@ -42,7 +47,7 @@ async def run_graph(inputs: dict):
 
 @pytest.mark.evaluator
 @pytest.mark.asyncio
-async def test_evaluate_graph(dataset_name = "LangGraph 101 Multi-Agent: Final Response"):
+async def test_evaluate_graph(persistence, dataset_name = "LangGraph 101 Multi-Agent: Final Response"):
     # Evaluation job and results
     experiment_results = await client.aevaluate(
         run_graph,
@@ -0,0 +1,58 @@
+import os
+import json
+import uuid
+
+import httpx
+import pytest
+from openai import AsyncOpenAI
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from langchain_core.messages import ToolMessage
+from agent.multiagent import model, multiagent
+
+
+def chat_completion(message: dict) -> httpx.Response:
+    """Wrap an assistant message in an OpenAI chat completion response."""
+    return httpx.Response(200, json={
+        "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": "o3-mini",
+        "choices": [{"index": 0, "message": {"role": "assistant", **message}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    })
+
+def tool_call(name: str, arguments: dict) -> dict:
+    return {"content": None, "tool_calls": [
+        {"id": f"call_{name}", "type": "function", "function": {"name": name, "arguments": json.dumps(arguments)}}
+    ]}
+
+def scripted_openai(request: httpx.Request) -> httpx.Response:
+    """Route to the invoice subagent, which looks up the invoices and then the invoice's employee."""
+    body = json.loads(request.content)
+    if body.get("response_format"):
+        return chat_completion({"content": json.dumps({"needs_subagent": True, "targets": ["invoice"], "response": ""})})
+    tool_names = [tool["function"]["name"] for tool in body.get("tools", [])]
+    if "get_invoices_by_customer_sorted_by_date" in tool_names:
+        tool_results = sum(message["role"] == "tool" for message in body["messages"])
+        if tool_results == 0:
+            return chat_completion(tool_call("get_invoices_by_customer_sorted_by_date", {}))
+        if tool_results == 1:
+            return chat_completion(tool_call("get_employee_by_invoice_and_customer", {"invoice_id": "1"}))
+    return chat_completion({"content": "Here are your invoice details."})
+
+
+@pytest.mark.asyncio
+async def test_invoice_turn_with_two_tool_calls(monkeypatch):
+    """An invoice question that needs two sequential tool calls finishes within the graph's recursion limit."""
+    # Swap the shared model's OpenAI client for one whose HTTP client is backed by the scripted transport
+    openai_client = AsyncOpenAI(api_key="sk-test", http_client=httpx.AsyncClient(transport=httpx.MockTransport(scripted_openai)))
+    monkeypatch.setattr(model, "root_async_client", openai_client)
+    monkeypatch.setattr(model, "async_client", openai_client.chat.completions)
+
+    result = await multiagent.ainvoke(
+        {"messages": [{"role": "user", "content": "Who was the employee on my most recent invoice?"}], "customer_id": 1},
+        config={"thread_id": uuid.uuid4()},
+    )
+
+    tool_calls = [message.name for message in result["messages"] if isinstance(message, ToolMessage)]
+    assert tool_calls == ["get_invoices_by_customer_sorted_by_date", "get_employee_by_invoice_and_customer"]
+    assert result["messages"][-1].content == "Here are your invoice details."